@@ -3,66 +3,227 @@ import numpy as np
 import joblib
 import os
 import logging
-import json
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import functools
+import math
+import mmap
+import threading
+import time
+import uuid
+import multiprocessing
+import orjson
+import anyio.to_thread
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Dict, Any, List
-from sklearn.metrics import mean_absolute_percentage_error
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 from fastapi.middleware.cors import CORSMiddleware  
 
+# --- Lock de Arquivo (Opcional) ---
+# fcntl só existe em Unix (onde roda o gunicorn); sem ele, o retreino não é serializado
+# entre processos, o que basta para o uvicorn com um único processo.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- ONNX Runtime (Opcional) ---
+# Se instalado, o modelo é exportado para ONNX e servido pelo onnxruntime.
+try:
+    import onnxruntime as ort
+    from onnxmltools.convert import convert_xgboost
+    from onnxmltools.convert.common.data_types import FloatTensorType
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
 # --- Configuração de Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- CONFIGURAÇÕES DE MLOPS ---
 FEEDBACK_PATH = 'data/feedback_local'
+FEEDBACK_LOG_PATH = os.path.join(FEEDBACK_PATH, 'feedback.jsonl') # Log append-only (1 JSON por linha)
+FEEDBACK_OFFSET_PATH = os.path.join(FEEDBACK_PATH, 'feedback.offset') # Byte até onde o log já foi treinado
+FEEDBACK_FSYNC_BYTES = 64 * 1024 # fsync a cada ~64 KB escritos no log
 MODEL_PATH = 'models/model.joblib'
+ONNX_MODEL_PATH = 'models/model.onnx' # Gerado a partir do model.joblib
 METRICS_PATH = 'models/model_metrics.json' # <-- NOVO
+MODEL_WATCH_INTERVAL = 2.0 # Segundos entre as checagens de um modelo novo em disco
+RETRAIN_LOCK_PATH = os.path.join(FEEDBACK_PATH, 'retrain.lock') # Um retreino por vez, entre todos os workers
+RETRAIN_JOBS_PATH = os.path.join(FEEDBACK_PATH, 'retrain_jobs') # Status de cada job (1 JSON por job_id)
+RETRAIN_TIMEOUT_SECONDS = 30 * 60 # Job 'running' há mais tempo que isso: o processo morreu sem gravar o status
+# Feedback já incorporado ao treino (a base 'merged_data.parquet' nunca é reescrita)
+FEEDBACK_OVERLAY_PATH = 'data/interim/merged_data_feedback.parquet'
 ERROR_THRESHOLD_MAPE = 0.15 
 # ------------------------------
 
 # --- Importar Funções de Outros Scripts ---
 try:
-    from src.features.build_features import engineer_features
+    from src.features.build_features import (
+        engineer_features_inference, compute_house_features, run_build_features,
+        parse_analysis_year, KERNEL_INPUTS, HOUSE_FEATURES
+    )
     from src.models.train_model import train as retrain_model 
-    logger.info("Módulos de 'engineer_features' e 'retrain_model' importados.")
+    logger.info("Módulos de features e 'retrain_model' importados.")
 except ImportError as e:
     logger.error(f"ERRO CRÍTICO ao importar módulos do SRC: {e}")
-    engineer_features = None
+    engineer_features_inference = None
+    compute_house_features = None
+    run_build_features = None
     retrain_model = None
 
 # --- Carregamento do Modelo (Global e Recarregável) ---
 model = None
 model_features = None
+feature_index = {} # Nome da feature -> coluna na matriz de entrada do modelo
+model_mtime = None # mtime (ns) do arquivo carregado, para não recarregar à toa
+onnx_session = None # InferenceSession do onnxruntime (None = usa model.predict)
 model_metrics = {} # <-- NOVO: Guardar métricas na memória
+artifacts_stamp = None # mtimes (modelo, métricas) da última carga, vigiados em 'watch_model_files'
+model_load_lock = threading.Lock()
+
+def read_artifacts_stamp() -> Tuple[Optional[int], Optional[int]]:
+    """mtime (ns) do modelo e do arquivo de métricas (None se o arquivo não existir)."""
+    stamp = []
+    for path in (MODEL_PATH, METRICS_PATH):
+        try:
+            stamp.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
 
 def load_model_safely():
-    """Tenta carregar o modelo E as métricas."""
-    global model, model_features, model_metrics # <-- Adiciona métricas
-    try:
-        model = joblib.load(MODEL_PATH)
-        model_features = model.feature_names_in_ 
-        logger.info(f"Modelo {MODEL_PATH} carregado com sucesso.")
+    """
+    Tenta carregar o modelo E as métricas.
+    O joblib só é desserializado de novo se o arquivo do modelo mudou (mtime).
+    """
+    global model, model_features, feature_index, model_mtime, model_metrics, artifacts_stamp # <-- Adiciona métricas
+    with model_load_lock: # O watcher e o fim de um retreino podem recarregar ao mesmo tempo
+        stamp = read_artifacts_stamp()
+        try:
+            mtime = os.stat(MODEL_PATH).st_mtime_ns
+            if model is None or mtime != model_mtime:
+                model = joblib.load(MODEL_PATH)
+                model_features = model.feature_names_in_ 
+                feature_index = {name: i for i, name in enumerate(model_features)}
+                model_mtime = mtime
+                load_onnx_session()
+                predict_cached.cache_clear() # Só libera memória: a chave já inclui o model_mtime
+                logger.info(f"Modelo {MODEL_PATH} carregado com sucesso.")
+            else:
+                logger.info(f"Modelo {MODEL_PATH} inalterado. Mantendo a versão em memória.")
         
-        # Tenta carregar as métricas
-        with open(METRICS_PATH, 'r') as f:
-            model_metrics = json.load(f)
-        logger.info(f"Métricas {METRICS_PATH} carregadas: MAE {model_metrics.get('mae_usd_formatted')}")
+            # Tenta carregar as métricas
+            with open(METRICS_PATH, 'rb') as f:
+                model_metrics = orjson.loads(f.read())
+            logger.info(f"Métricas {METRICS_PATH} carregadas: MAE {format_confidence_margin()}")
         
-        return True
+            artifacts_stamp = stamp
+            return True
+        except Exception as e:
+            logger.error(f"ERRO CRÍTICO ao carregar artefatos: {e}")
+            # Se as métricas falharem, usa um padrão
+            model_metrics = {} # Sem métricas: a margem de confiança aparece como N/A
+            if model_mtime == stamp[0]:
+                artifacts_stamp = stamp # O modelo está em dia: não tenta de novo até os arquivos mudarem
+            if model is None: # Se o modelo falhou, é crítico
+                return False
+            return True # Se só as métricas falharam, ainda podemos prever
+
+def format_confidence_margin() -> str:
+    """Margem de confiança exibida nas predições: a MAE do modelo atual, formatada em $."""
+    mae_usd = model_metrics.get("mae_usd")
+    if mae_usd is None:
+        return "$ (Erro N/A)"
+    return f"${mae_usd:,.2f}"
+
+def load_onnx_session():
+    """
+    Exporta o modelo carregado para ONNX (se o .onnx não existir ou for mais antigo
+    que o .joblib) e abre uma InferenceSession. Em qualquer falha, a API continua
+    usando o 'model.predict' do XGBoost.
+    """
+    global onnx_session
+    onnx_session = None
+    if not ONNX_AVAILABLE:
+        return
+    try:
+        if (not os.path.exists(ONNX_MODEL_PATH)
+                or os.path.getmtime(ONNX_MODEL_PATH) < os.path.getmtime(MODEL_PATH)):
+            booster = model.get_booster().copy()
+            booster.feature_names = None # O conversor exige os nomes padrão 'f0', 'f1', ...
+            onnx_model = convert_xgboost(
+                booster, initial_types=[('X', FloatTensorType([None, len(model_features)]))]
+            )
+            temp_path = f"{ONNX_MODEL_PATH}.{os.getpid()}.tmp" # Vários workers podem exportar ao mesmo tempo
+            with open(temp_path, 'wb') as f:
+                f.write(onnx_model.SerializeToString())
+            os.replace(temp_path, ONNX_MODEL_PATH)
+            logger.info(f"Modelo exportado para ONNX em {ONNX_MODEL_PATH}.")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        onnx_session = ort.InferenceSession(
+            ONNX_MODEL_PATH, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        logger.info("Predições servidas pelo ONNX Runtime.")
     except Exception as e:
-        logger.error(f"ERRO CRÍTICO ao carregar artefatos: {e}")
-        # Se as métricas falharem, usa um padrão
-        model_metrics = {"mae_usd_formatted": "$ (Métricas não encontradas)"}
-        if model is None: # Se o modelo falhou, é crítico
-            return False
-        return True # Se só as métricas falharam, ainda podemos prever
+        logger.warning(f"ONNX indisponível, usando o modelo XGBoost: {e}")
+        onnx_session = None
+
+def predict_log(X: np.ndarray) -> np.ndarray:
+    """Predição em log_price para a matriz X (float32): ONNX Runtime se disponível, senão XGBoost."""
+    if onnx_session is not None:
+        return onnx_session.run(None, {'X': X})[0].ravel()
+    return model.predict(X)
 
 # --- Definir o App FastAPI e Pydantic ---
+class ORJSONResponse(JSONResponse):
+    """Resposta JSON serializada com orjson (aceita valores NumPy, como as métricas)."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+# Threads para a inferência (CPU-bound): mais threads que núcleos só disputam o GIL.
+# Limiter próprio: o limiter padrão do anyio (40 threads) continua atendendo os
+# endpoints síncronos (/feedback, /check-performance, /retrain/{job_id}).
+PREDICT_THREADS = os.cpu_count() or 1
+predict_limiter = anyio.CapacityLimiter(PREDICT_THREADS)
+
+async def run_inference(func, *args):
+    """Roda 'func(*args)' numa thread do limiter de inferência, liberando o event loop."""
+    return await anyio.to_thread.run_sync(func, *args, limiter=predict_limiter)
+
+async def watch_model_files():
+    """
+    Recarrega o modelo quando os arquivos em disco mudam. O retreino roda num
+    processo à parte e, com o gunicorn, cada worker tem seu próprio modelo em
+    memória: cada um percebe sozinho o modelo novo (e limpa o seu 'predict_cached').
+    """
+    while True:
+        await anyio.sleep(MODEL_WATCH_INTERVAL)
+        if read_artifacts_stamp() != artifacts_stamp:
+            # Fora do event loop: desserializar o joblib e exportar o ONNX são lentos
+            await run_in_threadpool(load_model_safely)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info(f"Threadpool de inferência com {PREDICT_THREADS} threads.")
+    # Roda em cada worker (depois do fork), vigiando o modelo em disco
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(watch_model_files)
+        yield
+        tg.cancel_scope.cancel()
+
 app = FastAPI(
     title="API de Previsão de Preços com MLOps Inteligente",
     description="Implementação do ciclo de predição e retreino baseado em performance.",
-    version="1.1.0"
+    version="1.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # --- 2. ADICIONAR O MIDDLEWARE DE CORS ---
@@ -75,10 +236,6 @@ app.add_middleware(
 )
 # ----------------------------------------
 
-# Carrega o modelo na inicialização
-if not load_model_safely():
-    logger.error("Servidor iniciando com modelo indisponível. Rode /retrain para corrigir.")
-
 # (Resto do seu código... Classes Pydantic)
 class HouseData(BaseModel):
     id: int
@@ -106,23 +263,92 @@ class HouseData(BaseModel):
 class FeedbackData(HouseData):
     ground_truth_price: float 
 
+def build_feature_matrix(records: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Monta a matriz (B, n_features) esperada pelo modelo para um lote de registros.
+    Colunas brutas são copiadas direto dos registros e as features derivadas vêm
+    de 'compute_house_features' (sem pandas). Features ausentes ficam com 0.
+    """
+    n = len(records)
+    first = records[0]
+    X = np.zeros((n, len(feature_index)), dtype=np.float32)
+    for name, j in feature_index.items():
+        if name in first:
+            X[:, j] = np.fromiter((r[name] for r in records), dtype=np.float64, count=n)
+
+    # Features derivadas (house_age, total_rooms, ...), com o ano de cada registro
+    inputs = [np.fromiter((r[c] for r in records), dtype=np.float64, count=n) for c in KERNEL_INPUTS]
+    years = np.fromiter((parse_analysis_year(r.get('date')) for r in records), dtype=np.float64, count=n)
+    derived = compute_house_features(*inputs, years)
+    for k, name in enumerate(HOUSE_FEATURES):
+        j = feature_index.get(name)
+        if j is not None:
+            X[:, j] = derived[:, k]
+    return X
+
+# Buffer (1, n_features) reaproveitado entre requisições, um por thread do threadpool
+row_buffers = threading.local()
+
+def get_row_buffer() -> np.ndarray:
+    """Retorna o buffer da thread atual, (re)alocando se o modelo mudou de shape."""
+    buf = getattr(row_buffers, 'buf', None)
+    if buf is None or buf.shape[1] != len(feature_index):
+        buf = np.zeros((1, len(feature_index)), dtype=np.float32)
+        row_buffers.buf = buf
+    return buf
+
+def fill_feature_row(record: Dict[str, Any], out: np.ndarray) -> np.ndarray:
+    """Versão de 1 registro de 'build_feature_matrix': escreve as features em 'out' (1, n_features)."""
+    out.fill(0.0)
+    row = out[0]
+    for name, j in feature_index.items():
+        if name in record:
+            row[j] = record[name]
+    derived = engineer_features_inference(record)
+    for k, name in enumerate(HOUSE_FEATURES):
+        j = feature_index.get(name)
+        if j is not None:
+            row[j] = derived[k]
+    return out
+
+# Campos que definem a predição (o 'id' não influencia o preço)
+PREDICTION_CACHE_FIELDS = tuple(f for f in HouseData.model_fields if f != 'id')
+
+@functools.lru_cache(maxsize=8192)
+def predict_cached(key: tuple) -> float:
+    """
+    Predição (em $) de um único imóvel, memoizada pelo conteúdo do payload.
+    'key' é (model_mtime, *campos na ordem de PREDICTION_CACHE_FIELDS): a geração
+    do modelo na chave garante que uma predição do modelo antigo, gravada depois
+    do 'cache_clear' em 'load_model_safely', nunca mais seja servida.
+    """
+    X = fill_feature_row(dict(zip(PREDICTION_CACHE_FIELDS, key[1:])), get_row_buffer())
+    return math.expm1(predict_log(X)[0])
+
+def predict_batch_prices(data: List[HouseData]) -> List[float]:
+    """Predições (em $) de um lote: features, inferência e expm1 (tudo no threadpool)."""
+    X = build_feature_matrix([d.model_dump() for d in data])
+    # expm1 em float64, como no /predict (math.expm1): os mesmos centavos nos dois endpoints
+    return np.expm1(predict_log(X).astype(np.float64)).tolist()
+
+# Carrega o modelo na inicialização
+if not load_model_safely():
+    logger.error("Servidor iniciando com modelo indisponível. Rode /retrain para corrigir.")
+
 # --- Endpoint de Predição (/predict) ---
 @app.post("/predict")
-def predict_price(data: HouseData):
+async def predict_price(data: HouseData):
     if model is None:
         raise HTTPException(status_code=500, detail="Modelo não carregado. Tente /retrain.")
     try:
-        input_data_dict = data.dict()
-        df = pd.DataFrame([input_data_dict])
-        df_processed = engineer_features(df)
-        df_final = df_processed.reindex(columns=model_features).fillna(0)
-        prediction_log = model.predict(df_final)
-        prediction_real = np.expm1(prediction_log[0])
-        prediction_real_float = float(prediction_real) 
+        # Payloads repetidos (retries da UI, painéis A/B) saem direto do cache
+        key = (model_mtime, *(getattr(data, f) for f in PREDICTION_CACHE_FIELDS))
+        # Só a inferência vai para o threadpool; o event loop segue livre
+        prediction_real_float = await run_inference(predict_cached, key)
         
         # --- ATUALIZAÇÃO ---
         # Puxa a margem de confiança dinâmica do modelo carregado
-        confidence_margin = model_metrics.get("mae_usd_formatted", "$ (Erro N/A)")
+        confidence_margin = format_confidence_margin()
         
         return {
             "message": "Predição realizada com sucesso.",
@@ -134,71 +360,297 @@ def predict_price(data: HouseData):
         logger.error(f"Erro na predição: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro interno no servidor: {e}")
 
+# --- Endpoint de Predição em Lote (/predict_batch) ---
+@app.post("/predict_batch")
+async def predict_price_batch(data: List[HouseData]):
+    if model is None:
+        raise HTTPException(status_code=500, detail="Modelo não carregado. Tente /retrain.")
+    if not data:
+        raise HTTPException(status_code=400, detail="Nenhum registro enviado para predição.")
+    try:
+        # Uma única chamada ao modelo para o lote inteiro, fora do event loop
+        predictions_real = await run_inference(predict_batch_prices, data)
+        
+        confidence_margin = format_confidence_margin()
+        
+        return {
+            "message": f"{len(predictions_real)} predições realizadas com sucesso.",
+            "predictions": [
+                {
+                    "id": d.id,
+                    "predicted_price": price,
+                    "predicted_price_usd": f"${price:,.2f}"
+                }
+                for d, price in zip(data, predictions_real)
+            ],
+            "confidence_margin_usd": confidence_margin
+        }
+    except Exception as e:
+        logger.error(f"Erro na predição em lote: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Erro interno no servidor: {e}")
+
+# --- Log de Feedback (JSONL + cursor) ---
+feedback_lock = threading.Lock()
+feedback_unsynced_bytes = 0
+
+def read_feedback_offset() -> int:
+    """Lê o cursor do log: bytes já consumidos por um retreino (0 se não existir)."""
+    try:
+        with open(FEEDBACK_OFFSET_PATH, 'r') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def commit_feedback_offset(offset: int):
+    """Grava o cursor de forma atômica (arquivo temporário + os.replace)."""
+    temp_path = FEEDBACK_OFFSET_PATH + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(str(offset))
+    os.replace(temp_path, FEEDBACK_OFFSET_PATH)
+
+def pending_feedback_range() -> Tuple[int, int]:
+    """
+    Trecho do log ainda não usado em um retreino: (cursor, fim da última linha completa).
+    Se não houver nada pendente, os dois valores são iguais.
+    """
+    offset = read_feedback_offset()
+    if not os.path.exists(FEEDBACK_LOG_PATH) or os.path.getsize(FEEDBACK_LOG_PATH) <= offset:
+        return offset, offset
+    with open(FEEDBACK_LOG_PATH, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Ignora uma eventual linha ainda sendo escrita no fim do arquivo
+        end = mm.rfind(b'\n', offset) + 1
+    return offset, max(end, offset)
+
+def iter_feedback(start: int, end: int) -> Iterator[Dict[str, Any]]:
+    """Percorre, linha a linha (via mmap), os feedbacks do log entre os bytes 'start' e 'end'."""
+    if end <= start:
+        return
+    with open(FEEDBACK_LOG_PATH, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        while pos < end:
+            line_end = mm.find(b'\n', pos, end)
+            if line_end == -1:
+                line_end = end
+            line = mm[pos:line_end]
+            pos = line_end + 1
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"Linha de feedback inválida ignorada: {e}")
+
+def read_pending_feedback():
+    """
+    Lê do log os feedbacks ainda não usados em um retreino (a partir do cursor).
+    Retorna (lista de registros, offset do fim da última linha completa lida).
+    """
+    offset, end = pending_feedback_range()
+    return list(iter_feedback(offset, end)), end
+
+def load_feedback_file(filename: str):
+    """Lê um feedback no formato antigo (1 arquivo .json). Retorna None se o arquivo for inválido."""
+    try:
+        with open(os.path.join(FEEDBACK_PATH, filename), 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        logger.warning(f"Erro ao ler arquivo de feedback {filename}: {e}")
+        return None
+
+def import_legacy_feedback():
+    """
+    Migra para o log JSONL os feedbacks pendentes no formato antigo (um .json por
+    feedback em FEEDBACK_PATH). Os arquivos são lidos em paralelo (o custo é a
+    latência de open/read, que libera o GIL) e depois movidos para 'archive/'.
+    """
+    if not os.path.isdir(FEEDBACK_PATH):
+        return
+    feedback_files = sorted(f for f in os.listdir(FEEDBACK_PATH) if f.endswith('.json'))
+    if not feedback_files:
+        return
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        feedback_data = list(executor.map(load_feedback_file, feedback_files))
+
+    with feedback_lock:
+        with open(FEEDBACK_LOG_PATH, 'ab') as f:
+            for data in feedback_data:
+                if data is not None:
+                    f.write(orjson.dumps(data) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    archive_path = os.path.join(FEEDBACK_PATH, 'archive')
+    os.makedirs(archive_path, exist_ok=True)
+    migrated = 0
+    for filename, data in zip(feedback_files, feedback_data):
+        if data is not None:
+            os.rename(os.path.join(FEEDBACK_PATH, filename), os.path.join(archive_path, filename))
+            migrated += 1
+    logger.info(f"{migrated} arquivos de feedback antigos migrados para {FEEDBACK_LOG_PATH}")
+
 # --- Endpoint de Feedback (/feedback) ---
 @app.post("/feedback")
 def receive_feedback(data: FeedbackData):
+    global feedback_unsynced_bytes
     os.makedirs(FEEDBACK_PATH, exist_ok=True)
-    feedback_data = data.dict()
-    timestamp = pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
-    file_name = os.path.join(FEEDBACK_PATH, f"feedback_{timestamp}_{data.id}.json")
+    line = orjson.dumps(data.model_dump()) + b'\n'
     try:
-        with open(file_name, 'w') as f:
-            json.dump(feedback_data, f, indent=4)
-        logger.info(f"Feedback salvo com sucesso em {file_name}")
-        return {"message": "Feedback recebido com sucesso!", "file": file_name}
+        with feedback_lock:
+            with open(FEEDBACK_LOG_PATH, 'ab') as f:
+                f.write(line)
+                feedback_unsynced_bytes += len(line)
+                if feedback_unsynced_bytes >= FEEDBACK_FSYNC_BYTES:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    feedback_unsynced_bytes = 0
+        logger.info(f"Feedback {data.id} registrado em {FEEDBACK_LOG_PATH}")
+        return {"message": "Feedback recebido com sucesso!", "file": FEEDBACK_LOG_PATH}
     except Exception as e:
         logger.error(f"Erro ao salvar feedback: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao salvar feedback: {e}")
 
+# --- Retreino em Processo Separado ---
+# O treino (~30-60s, CPU-bound) roda fora do processo da API para não travar o /predict.
+# 'spawn' evita herdar locks/threads do servidor no processo filho.
+# O pool é criado sob demanda: com o gunicorn ('preload_app'), cada worker
+# precisa do seu próprio pool, e não de uma cópia (via fork) do pool do master.
+# O status de cada job vai para disco, então qualquer worker responde o GET /retrain/{job_id}.
+retrain_executor: Optional[ProcessPoolExecutor] = None
+retrain_jobs: Dict[str, Future] = {} # job_id -> Future do 'run_retrain_job' (jobs deste worker)
+retrain_submit_lock = threading.Lock() # Endpoints síncronos rodam em threads: checa e submete de uma vez
+
+def get_retrain_executor(recreate: bool = False) -> ProcessPoolExecutor:
+    """Retorna o pool de retreino deste processo, criando-o na primeira chamada."""
+    global retrain_executor
+    if retrain_executor is None or recreate:
+        retrain_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    return retrain_executor
+
+@contextmanager
+def retrain_lock():
+    """
+    Lock exclusivo (fcntl.flock) compartilhado por todos os processos: só um
+    retreino por vez escreve o overlay, o modelo e o cursor do log.
+    Um segundo retreino espera o primeiro terminar.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(FEEDBACK_PATH, exist_ok=True)
+    with open(RETRAIN_LOCK_PATH, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def retrain_status_path(job_id: str) -> str:
+    return os.path.join(RETRAIN_JOBS_PATH, f"{job_id}.json")
+
+def write_retrain_status(job_id: str, status: Dict[str, Any]):
+    """Grava o status do job de forma atômica (arquivo temporário + os.replace)."""
+    os.makedirs(RETRAIN_JOBS_PATH, exist_ok=True)
+    path = retrain_status_path(job_id)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(orjson.dumps({"job_id": job_id, **status}, option=orjson.OPT_SERIALIZE_NUMPY))
+    os.replace(temp_path, path)
+
+def read_retrain_status(job_id: str) -> Optional[Dict[str, Any]]:
+    """Lê o status gravado por 'write_retrain_status' (None se o job não existir)."""
+    try:
+        with open(retrain_status_path(job_id), 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def retrain_result_status(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Converte o retorno de 'run_full_retrain_cycle' no status exposto em GET /retrain/{job_id}."""
+    if "error" in result:
+        return {"status": "failed", "error": result["error"]}
+    return {"status": "done", "new_metrics": result} # <-- RETORNA AS NOVAS MÉTRICAS
+
+def on_retrain_done(job_id: str, future: Future):
+    """Callback no processo da API: recarrega o modelo quando o retreino termina com sucesso."""
+    try:
+        result = future.result()
+    except Exception as e:
+        # O processo de retreino morreu sem gravar o status final
+        logger.error(f"ERRO: Job de retreino falhou: {e}")
+        write_retrain_status(job_id, {"status": "failed", "error": str(e)})
+        return
+    if "error" in result:
+        logger.error(f"ERRO: Retreino não concluído: {result['error']}")
+        return
+    # Os outros workers pegam o modelo novo em 'watch_model_files'
+    if load_model_safely():
+        logger.warning("--- SUCESSO: NOVO MODELO CARREGADO NA API! ---")
+
+def submit_retrain(feedback_data: Optional[List[Dict[str, Any]]] = None,
+                   feedback_start_offset: Optional[int] = None,
+                   feedback_end_offset: Optional[int] = None) -> str:
+    """
+    Dispara o retreino (se nenhum estiver rodando neste worker) e retorna o job_id.
+    O feedback já lido pelo chamador (bytes 'feedback_start_offset' a 'feedback_end_offset'
+    do log) é repassado ao retreino, que só relê o log se o cursor tiver andado.
+    """
+    with retrain_submit_lock:
+        for job_id, future in retrain_jobs.items():
+            if not future.done():
+                logger.info(f"Retreino {job_id} já em andamento.")
+                return job_id
+        job_id = uuid.uuid4().hex
+        write_retrain_status(job_id, {"status": "running", "started_at": time.time()})
+        job_args = (run_retrain_job, job_id, feedback_data, feedback_start_offset, feedback_end_offset)
+        try:
+            future = get_retrain_executor().submit(*job_args)
+        except BrokenProcessPool:
+            # O processo de retreino morreu (ex.: OOM); recria o pool e tenta de novo
+            future = get_retrain_executor(recreate=True).submit(*job_args)
+        future.add_done_callback(functools.partial(on_retrain_done, job_id))
+        retrain_jobs[job_id] = future
+        return job_id
+
+# Feedbacks antigos (.json) ainda pendentes entram no log na inicialização
+try:
+    import_legacy_feedback()
+except Exception as e:
+    logger.error(f"Erro ao migrar feedbacks antigos: {e}", exc_info=True)
+
 # --- Endpoint de Verificação de Performance ---
 @app.post("/check-performance")
-def check_model_performance(background_tasks: BackgroundTasks): # MANTEMOS O NOME, MAS MUDAMOS A LÓGICA
+def check_model_performance(response: Response): # MANTEMOS O NOME, MAS MUDAMOS A LÓGICA
     logger.info("--- INICIANDO VERIFICAÇÃO DE PERFORMANCE ---")
-    if not os.path.exists(FEEDBACK_PATH):
-        return {"retrain_triggered": False, "message": "Nenhum dado de feedback para checar."}
-    feedback_files = [f for f in os.listdir(FEEDBACK_PATH) if f.endswith('.json')]
-    if not feedback_files:
-        return {"retrain_triggered": False, "message": "Nenhum dado de feedback para checar."}
-
-    feedback_data = []
-    for filename in feedback_files:
-        try:
-            with open(os.path.join(FEEDBACK_PATH, filename), 'r') as f:
-                feedback_data.append(json.load(f))
-        except Exception as e:
-            logger.warning(f"Erro ao ler arquivo de feedback {filename}: {e}")
+    feedback_start_offset, feedback_end_offset = pending_feedback_range()
+    feedback_data = list(iter_feedback(feedback_start_offset, feedback_end_offset))
     if not feedback_data:
-        return {"retrain_triggered": False, "message": "Dados de feedback vazios."}
+        return {"retrain_triggered": False, "message": "Nenhum dado de feedback para checar."}
 
     try:
-        y_true, y_pred = [], []
-        for data in feedback_data:
-            y_true.append(data['ground_truth_price'])
-            df = pd.DataFrame([data])
-            df_processed = engineer_features(df)
-            df_final = df_processed.reindex(columns=model_features).fillna(0)
-            prediction_log = model.predict(df_final)
-            y_pred.append(np.expm1(prediction_log[0]))
-
-        current_mape = mean_absolute_percentage_error(y_true, y_pred)
+        # Uma única passada de features e uma única chamada ao modelo para todo o feedback
+        y_true = np.fromiter((d['ground_truth_price'] for d in feedback_data), dtype=np.float64, count=len(feedback_data))
+        y_pred = np.expm1(predict_log(build_feature_matrix(feedback_data)).astype(np.float64))
+
+        current_mape = float(np.mean(np.abs(y_true - y_pred) / np.maximum(np.abs(y_true), 1e-8)))
         logger.info(f"MAPE ATUAL (nos {len(y_true)} novos dados): {current_mape:.4f}")
         logger.info(f"LIMITE DE ERRO (Threshold): {ERROR_THRESHOLD_MAPE:.4f}")
 
         if current_mape > ERROR_THRESHOLD_MAPE:
             logger.warning(f"GATILHO ATIVADO! Erro atual ({current_mape:.4f}) > Limite ({ERROR_THRESHOLD_MAPE:.4f})")
             
-            # --- ATUALIZAÇÃO: REMOVE BACKGROUND TASK ---
-            # background_tasks.add_task(run_full_retrain_cycle) # <-- REMOVIDO
-            
-            # Executa o retreino AGORA (síncrono)
-            # A API vai travar aqui por ~30-60s, o que é BOM para a simulação
-            new_metrics = run_full_retrain_cycle()
+            # Dispara o retreino em outro processo e responde na hora (202 Accepted).
+            # O andamento é consultado em GET /retrain/{job_id}.
+            # O retreino recebe o feedback já lido aqui (uma única leitura do log).
+            job_id = submit_retrain(feedback_data, feedback_start_offset, feedback_end_offset)
+            response.status_code = 202
             
             return {
                 "retrain_triggered": True,
-                "message": f"Erro (MAPE) de {current_mape:.2%} excedeu o limite. Retreino CONCLUÍDO!",
+                "message": f"Erro (MAPE) de {current_mape:.2%} excedeu o limite. Retreino INICIADO!",
                 "current_mape_pct": f"{current_mape:.2%}",
-                "new_metrics": new_metrics # <-- RETORNA AS NOVAS MÉTRICAS
+                "job_id": job_id,
+                "status": "running"
             }
         else:
             logger.info("Performance do modelo está estável.")
@@ -211,53 +663,79 @@ def check_model_performance(background_tasks: BackgroundTasks): # MANTEMOS O NOM
         logger.error(f"Erro ao calcular performance: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao calcular performance: {e}")
 
-# --- Função de Retreino (agora chamada pelo /check-performance) ---
-def run_full_retrain_cycle():
+# --- Endpoint de Status do Retreino ---
+@app.get("/retrain/{job_id}")
+def get_retrain_status(job_id: str):
+    try:
+        job_id = uuid.UUID(job_id).hex # Só ids válidos viram nome de arquivo
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Job de retreino {job_id} não encontrado.")
+    status = read_retrain_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job de retreino {job_id} não encontrado.")
+    if status["status"] == "running" and time.time() - status.get("started_at", 0) > RETRAIN_TIMEOUT_SECONDS:
+        # O worker (ou o processo de retreino) caiu no meio do treino e ninguém gravou o fim
+        status = {"status": "failed", "error": f"Retreino sem resposta há mais de {RETRAIN_TIMEOUT_SECONDS // 60} minutos."}
+        write_retrain_status(job_id, status)
+        return {"job_id": job_id, **status}
+    return status
+
+# --- Função de Retreino (executada no processo de retreino, via /check-performance) ---
+def run_full_retrain_cycle(feedback_data: Optional[List[Dict[str, Any]]] = None,
+                           feedback_start_offset: Optional[int] = None,
+                           feedback_end_offset: Optional[int] = None):
     """
-    Executa o ciclo MLOps: coleta, treina, recarrega e RETORNA as novas métricas.
+    Executa o ciclo MLOps: coleta, treina, valida o novo modelo e RETORNA as novas métricas.
+    Roda no 'retrain_executor'; a API recarrega o modelo em 'on_retrain_done'.
+    Se 'feedback_data' vier do /check-performance, o log não é lido de novo,
+    a menos que outro retreino já tenha consumido parte desse trecho.
     """
-    global model, model_features, model_metrics # <-- Garante que vamos atualizar globais
     logger.info("--- INICIANDO CICLO DE RETREINO ---")
-    try:
-        original_df = pd.read_csv('data/interim/merged_data.csv')
-    except Exception as e:
-        logger.error(f"Erro ao carregar dados originais para retreino: {e}. Abortando.")
-        return {"error": "Falha ao carregar dados originais."}
-
-    feedback_files = [f for f in os.listdir(FEEDBACK_PATH) if f.endswith('.json')]
-    if not feedback_files:
+    if feedback_data is None or feedback_start_offset is None or feedback_end_offset is None:
+        feedback_data, feedback_end_offset = read_pending_feedback()
+    else:
+        # O cursor é relido sob o 'retrain_lock': um retreino que rodou antes deste
+        # pode já ter incorporado (parte d)o trecho lido pelo /check-performance
+        committed_offset = read_feedback_offset()
+        if committed_offset >= feedback_end_offset:
+            logger.info("Feedback já incorporado por outro retreino. Mantendo o modelo atual.")
+            with open(METRICS_PATH, 'rb') as f:
+                return orjson.loads(f.read())
+        if committed_offset > feedback_start_offset:
+            feedback_data, feedback_end_offset = read_pending_feedback()
+    if not feedback_data:
         logger.info("Retreino chamado, mas sem novos dados de feedback. Abortando.")
         return {"error": "Nenhum feedback para treinar."}
 
-    feedback_data = []
-    for filename in feedback_files:
-        try:
-            with open(os.path.join(FEEDBACK_PATH, filename), 'r') as f:
-                feedback_data.append(json.load(f))
-        except Exception as e:
-            logger.warning(f"Erro ao ler arquivo de feedback {filename}: {e}")
-
     logger.info(f"Coletados {len(feedback_data)} novos pontos de feedback para o treino.")
     new_data_df = pd.DataFrame(feedback_data).rename(columns={'ground_truth_price': 'price'})
-    updated_df = pd.concat([original_df, new_data_df], ignore_index=True, sort=False)
-    temp_path = 'data/interim/temp_updated_merged_data.csv'
-    updated_df.to_csv(temp_path, index=False)
 
+    # O feedback vai para um arquivo à parte, lido junto com a base em 'run_build_features'.
+    # Guardamos o anterior (pequeno) para desfazer caso o retreino falhe.
+    previous_overlay_df = None
+    if os.path.exists(FEEDBACK_OVERLAY_PATH):
+        previous_overlay_df = pd.read_parquet(FEEDBACK_OVERLAY_PATH, engine='pyarrow')
+        new_data_df = pd.concat([previous_overlay_df, new_data_df], ignore_index=True, sort=False)
+    temp_path = FEEDBACK_OVERLAY_PATH + '.tmp'
+    new_data_df.to_parquet(temp_path, engine='pyarrow', compression='zstd', index=False)
+
+    success = False
     try:
-        os.replace(temp_path, 'data/interim/merged_data.csv')
+        os.replace(temp_path, FEEDBACK_OVERLAY_PATH)
         
         # --- TREINAR NOVO MODELO ---
-        # A função 'train()' agora retorna as métricas
+        # Reconstrói train/test com o feedback e treina; 'train()' retorna as métricas
+        if not run_build_features():
+            raise RuntimeError("Falha ao reconstruir as features de treino.")
         new_metrics = retrain_model() 
         
-        # --- RECARREGAR O MODELO NA API ---
+        # --- VALIDAR O NOVO MODELO (e já exportar o ONNX) ---
         if load_model_safely():
-            logger.warning("--- SUCESSO: NOVO MODELO CARREGADO NA API! ---")
-            archive_path = os.path.join(FEEDBACK_PATH, 'archive')
-            os.makedirs(archive_path, exist_ok=True)
-            for filename in feedback_files:
-                os.rename(os.path.join(FEEDBACK_PATH, filename), os.path.join(archive_path, filename))
-            logger.info(f"Arquivos de feedback processados movidos para {archive_path}")
+            logger.info("Novo modelo validado no processo de retreino.")
+            # Avança o cursor: esses feedbacks já fazem parte do treino
+            commit_feedback_offset(feedback_end_offset)
+            logger.info(f"Cursor do log de feedback avançado para o byte {feedback_end_offset}")
+            success = True
             
             return new_metrics # Retorna as métricas do novo modelo
         else:
@@ -268,8 +746,23 @@ def run_full_retrain_cycle():
         logger.error(f"ERRO CRÍTICO no ciclo de retreino: {e}", exc_info=True)
         return {"error": str(e)}
     finally:
-        # Restaura o arquivo original
-        original_df.to_csv('data/interim/merged_data.csv', index=False)
+        # Sem sucesso, o feedback continua pendente: desfaz o overlay
+        if not success:
+            if previous_overlay_df is not None:
+                previous_overlay_df.to_parquet(FEEDBACK_OVERLAY_PATH, engine='pyarrow', compression='zstd', index=False)
+            elif os.path.exists(FEEDBACK_OVERLAY_PATH):
+                os.remove(FEEDBACK_OVERLAY_PATH)
         if os.path.exists(temp_path):
             os.remove(temp_path)
-    logger.info("--- CICLO DE RETREINO CONCLUÍDO (COM RESTAURAÇÃO) ---")
\ No newline at end of file
+
+def run_retrain_job(job_id: str, feedback_data: Optional[List[Dict[str, Any]]] = None,
+                    feedback_start_offset: Optional[int] = None,
+                    feedback_end_offset: Optional[int] = None):
+    """
+    Ponto de entrada no processo de retreino: roda o ciclo sob o 'retrain_lock'
+    (entre a escrita do overlay e o avanço do cursor) e grava o status final do job.
+    """
+    with retrain_lock():
+        result = run_full_retrain_cycle(feedback_data, feedback_start_offset, feedback_end_offset)
+    write_retrain_status(job_id, retrain_result_status(result))
+    return result
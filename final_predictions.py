@@ -4,15 +4,15 @@ import joblib
 import os
 import logging
 import time
-import json # Necessário para ler o arquivo de métricas
+import orjson # Necessário para ler o arquivo de métricas
 
 # --- Importar a função de engenharia de features ---
 # (Assumindo que src/features/build_features.py existe no seu projeto)
 try:
-    from src.features.build_features import engineer_features
+    from src.features.build_features import engineer_features_train
 except ImportError:
-    logging.error("ERRO CRÍTICO: Não foi possível importar 'engineer_features'. Verifique o caminho.")
-    engineer_features = None
+    logging.error("ERRO CRÍTICO: Não foi possível importar 'engineer_features_train'. Verifique o caminho.")
+    engineer_features_train = None
 
 # --- Configuração de Logging ---
 logging.basicConfig(
@@ -31,8 +31,8 @@ def run_batch_predictions():
     RETORNA:
         (pd.DataFrame, dict): Tupla contendo (DataFrame de resultados, dicionário de métricas).
     """
-    if engineer_features is None:
-        logger.error("Pipeline abortado. 'engineer_features' não foi importado.")
+    if engineer_features_train is None:
+        logger.error("Pipeline abortado. 'engineer_features_train' não foi importado.")
         return None, None
 
     logger.info("Iniciando pipeline de predição em LOTE...")
@@ -59,8 +59,8 @@ def run_batch_predictions():
         logger.info("Modelo carregado com sucesso.")
         
         # Carregar MAE (Erro Absoluto Médio) para a margem de confiança
-        with open(METRICS_PATH, 'r') as f:
-            metrics = json.load(f)
+        with open(METRICS_PATH, 'rb') as f:
+            metrics = orjson.loads(f.read())
         mae_usd = metrics.get('mae_usd', 0)
         logger.info(f"Métrica MAE carregada: ${mae_usd:,.2f}")
         
@@ -75,8 +75,9 @@ def run_batch_predictions():
     # --- 3. Carregar Dados de Entrada ---
     try:
         logger.info(f"Carregando dados não vistos de {UNSEEN_DATA_PATH}...")
-        unseen_df = pd.read_csv(UNSEEN_DATA_PATH)
-        demographics_df = pd.read_csv(DEMOGRAPHICS_PATH)
+        # Colunas tipadas pelo Arrow: menos memória e merge mais rápido
+        unseen_df = pd.read_csv(UNSEEN_DATA_PATH, dtype_backend='pyarrow')
+        demographics_df = pd.read_csv(DEMOGRAPHICS_PATH, dtype_backend='pyarrow')
     except FileNotFoundError as e:
         logger.error(f"Erro: Arquivo de dados não encontrado. {e}")
         return None, None
@@ -104,29 +105,31 @@ def run_batch_predictions():
     merged_unseen_df = pd.merge(unseen_df, demographics_df, on='zipcode', how='left')
 
     # Aplicar a mesma engenharia de features do treino
-    processed_unseen_df = engineer_features(merged_unseen_df)
+    processed_unseen_df = engineer_features_train(merged_unseen_df)
 
     # --- 6. Alinhar Colunas e Prever ---
-    final_unseen_df = processed_unseen_df.reindex(columns=model_features).fillna(0)
+    # Matriz float32 montada coluna a coluna na ordem de 'model_features'
+    # (sem o reindex/fillna do pandas). Colunas ausentes e nulos ficam com 0.
+    X = np.zeros((len(processed_unseen_df), len(model_features)), dtype=np.float32)
+    for j, name in enumerate(model_features):
+        if name in processed_unseen_df.columns:
+            X[:, j] = processed_unseen_df[name].to_numpy(dtype=np.float32, na_value=0.0)
 
-    logger.info(f"Realizando predições em {len(final_unseen_df)} registros...")
-    predictions_log = model.predict(final_unseen_df)
+    logger.info(f"Realizando predições em {len(X)} registros...")
+    predictions_log = model.predict(X)
     predictions_usd = np.expm1(predictions_log)
 
     # --- 7. Salvar Resultados (Com Margem de Confiança) ---
     logger.info("Salvando resultados...")
     
-    # Criar o DataFrame final
+    # Criar o DataFrame final (preço já arredondado para duas casas decimais)
     output_df = pd.DataFrame({
         'id': original_ids,
-        'predicted_price_usd': predictions_usd,
+        'predicted_price_usd': np.round(predictions_usd, 2),
         'confidence_margin': confidence_margin # Coluna de precisão adicionada!
     })
     
-    # Formatar o preço para duas casas decimais
-    output_df['predicted_price_usd'] = output_df['predicted_price_usd'].apply(lambda x: round(x, 2))
-    
-    output_df.to_csv(OUTPUT_FILE, index=False)
+    output_df.to_csv(OUTPUT_FILE, index=False, float_format='%.2f')
     
     elapsed = time.time() - start_time
     logger.info("="*50)
@@ -151,8 +154,8 @@ if __name__ == "__main__":
 
         # 2. Imprimir as métricas do modelo (carregadas do arquivo JSON)
         print("\n--- MÉTRICAS DE PERFORMANCE DO MODELO (do conjunto de teste) ---")
-        # Usar json.dumps para formatar o dicionário de forma legível
-        print(json.dumps(model_metrics, indent=4))
+        # Usar orjson.dumps para formatar o dicionário de forma legível
+        print(orjson.dumps(model_metrics, option=orjson.OPT_INDENT_2).decode())
         print("----------------------------------------------------------------\n")
         
         # 3. Informar sobre o gráfico
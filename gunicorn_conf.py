@@ -0,0 +1,25 @@
+# --- Configuração do Gunicorn (API em produção com vários workers) ---
+# Uso: gunicorn -c gunicorn_conf.py api:app
+#
+# O '/predict' é CPU-bound: um único processo uvicorn satura um núcleo.
+# Aqui sobem N workers uvicorn (uvloop + httptools, via 'uvicorn[standard]').
+# Com 'preload_app', o 'api' é importado UMA vez no master (modelo já carregado
+# por 'load_model_safely') e os workers nascem por fork, compartilhando as
+# páginas do modelo por copy-on-write enquanto ele não é recarregado.
+import os
+
+bind = os.environ.get("API_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("API_WORKERS", os.cpu_count() or 1))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+timeout = 120
+
+def post_fork(server, worker):
+    """
+    Roda em cada worker logo após o fork. A InferenceSession do onnxruntime
+    mantém pools de threads que não sobrevivem ao fork, então cada worker
+    abre a sua própria sessão (o modelo em si continua compartilhado).
+    """
+    import api
+    if api.model is not None:
+        api.load_onnx_session()
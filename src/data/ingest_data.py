@@ -1,12 +1,22 @@
 # src/data/ingest_data.py
 import pandas as pd
 import os
+import logging
+
+# --- Configuração de Logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+# ---------------------------------
 
 def run_ingestion():
     """
     Carrega os dados brutos, faz o merge e salva em data/interim.
     """
-    print("Iniciando ingestão de dados...")
+    logger.info("Iniciando ingestão de dados...")
     
     # Caminhos
     RAW_PATH = 'data/raw'
@@ -20,8 +30,8 @@ def run_ingestion():
         df_house = pd.read_csv(os.path.join(RAW_PATH, 'kc_house_data.csv'))
         df_demo = pd.read_csv(os.path.join(RAW_PATH, 'zipcode_demographics.csv'))
     except FileNotFoundError as e:
-        print(f"Erro: Arquivo não encontrado. {e}")
-        print("Certifique-se que 'kc_house_data.csv' e 'zipcode_demographics.csv' estão em data/raw/")
+        logger.error(f"Erro: Arquivo não encontrado. {e}")
+        logger.error("Certifique-se que 'kc_house_data.csv' e 'zipcode_demographics.csv' estão em data/raw/")
         return
 
     # Renomear coluna de merge em df_demo (ajuste se o nome for outro)
@@ -31,12 +41,12 @@ def run_ingestion():
     # Fazer o merge
     df_merged = pd.merge(df_house, df_demo, on='zipcode', how='inner')
     
-    # Salvar dados merjados
-    output_path = os.path.join(INTERIM_PATH, 'merged_data.csv')
-    df_merged.to_csv(output_path, index=False)
+    # Salvar dados merjados (Parquet: colunar, tipado e comprimido)
+    output_path = os.path.join(INTERIM_PATH, 'merged_data.parquet')
+    df_merged.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
     
-    print(f"Dados merjados salvos com sucesso em: {output_path}")
-    print(f"Formato dos dados: {df_merged.shape}")
+    logger.info(f"Dados merjados salvos com sucesso em: {output_path}")
+    logger.info(f"Formato dos dados: {df_merged.shape}")
 
 if __name__ == "__main__":
     # Permite executar este script diretamente do terminal
@@ -3,8 +3,91 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 import os
+import logging
+import functools
 
-def engineer_features(df):
+# --- Configuração de Logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+# ---------------------------------
+
+# --- Numba (Opcional) ---
+# Compila o kernel de features usado no caminho de predição da API.
+# Sem numba, as mesmas funções rodam em Python puro.
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+ANALYSIS_YEAR_DEFAULT = 2015 # Ano máximo do dataset
+
+# Entradas brutas do kernel (na ordem dos argumentos) e features que ele gera
+KERNEL_INPUTS = ('yr_built', 'yr_renovated', 'bedrooms', 'bathrooms', 'sqft_living')
+HOUSE_FEATURES = ('house_age', 'time_since_renovation', 'was_renovated', 'total_rooms', 'sqft_per_room')
+
+def _feat_kernel(yr_built, yr_renovated, bedrooms, bathrooms, sqft_living, year):
+    """
+    Kernel escalar (1 imóvel) das features de imóvel.
+    Retorna uma tupla na ordem de HOUSE_FEATURES.
+    """
+    house_age = float(year - yr_built)
+    if yr_renovated == 0:
+        time_since_renovation = house_age # Se nunca reformou
+    else:
+        time_since_renovation = float(year - yr_renovated) # Se reformou
+    was_renovated = 1.0 if yr_renovated > 0 else 0.0
+    total_rooms = float(bedrooms + bathrooms)
+    # Evitar divisão por zero se total_rooms for 0
+    sqft_per_room = sqft_living / (total_rooms + 1e-6)
+    return house_age, time_since_renovation, was_renovated, total_rooms, sqft_per_room
+
+def _feat_kernel_batch(yr_built, yr_renovated, bedrooms, bathrooms, sqft_living, year, out):
+    """
+    Versão em lote do kernel: recebe arrays de tamanho B e escreve
+    o resultado em 'out', com shape (B, len(HOUSE_FEATURES)).
+    """
+    for i in range(yr_built.shape[0]):
+        f0, f1, f2, f3, f4 = feat_kernel(
+            yr_built[i], yr_renovated[i], bedrooms[i], bathrooms[i], sqft_living[i], year[i]
+        )
+        out[i, 0] = f0
+        out[i, 1] = f1
+        out[i, 2] = f2
+        out[i, 3] = f3
+        out[i, 4] = f4
+
+if NUMBA_AVAILABLE:
+    # Rodando como script (__main__), o cache em disco seria o mesmo do módulo
+    # importado ('src.features.build_features'), mas com outro nome: compila sem cache.
+    _use_cache = __name__ != '__main__'
+    feat_kernel = njit(cache=_use_cache, fastmath=True)(_feat_kernel)
+    feat_kernel_batch = njit(cache=_use_cache, fastmath=True)(_feat_kernel_batch)
+else:
+    feat_kernel = _feat_kernel
+    feat_kernel_batch = _feat_kernel_batch
+
+def parse_analysis_year(date):
+    """Extrai o ano de uma data 'YYYYMMDDT...'. Usa ANALYSIS_YEAR_DEFAULT se inválida."""
+    try:
+        return int(str(date)[:4])
+    except (TypeError, ValueError):
+        return ANALYSIS_YEAR_DEFAULT
+
+def compute_house_features(yr_built, yr_renovated, bedrooms, bathrooms, sqft_living, year):
+    """
+    Calcula HOUSE_FEATURES sobre colunas NumPy de mesmo tamanho B.
+    Retorna um array (B, len(HOUSE_FEATURES)). Base comum do treino e da predição em lote.
+    """
+    out = np.empty((len(yr_built), len(HOUSE_FEATURES)), dtype=np.float64)
+    feat_kernel_batch(yr_built, yr_renovated, bedrooms, bathrooms, sqft_living, year, out)
+    return out
+
+def engineer_features_train(df):
     """
     Recebe um DataFrame (bruto ou merjado) e aplica 
     toda a engenharia de features SEGURA (row-wise).
@@ -12,9 +95,10 @@ def engineer_features(df):
     Esta função NÃO deve conter features que "aprendem" com os dados,
     como Scalers ou KMeans, para evitar a necessidade de um preprocessor.
     
-    Retorna o DataFrame com as novas colunas.
+    Retorna o DataFrame com as novas colunas (e 'log_price', se houver 'price').
+    Usada no treino e na predição em lote; a API usa 'engineer_features_inference'.
     """
-    print("Aplicando engenharia de features...")
+    logger.debug("Aplicando engenharia de features...")
     # Copia para evitar SettingWithCopyWarning
     df = df.copy()
 
@@ -27,48 +111,66 @@ def engineer_features(df):
     # Tenta encontrar o ano de análise. Se 'date' não existir (ex: na predição), 
     # usamos 2015 como padrão (ano máximo do dataset).
     if 'date' in df.columns:
-        # Converte 'date' para datetime (pegando só a data)
-        try:
-            df['date_dt'] = pd.to_datetime(df['date'].str.split('T').str[0])
-            analysis_year = df['date_dt'].dt.year.max()
-        except:
-            analysis_year = 2015 # Fallback
+        # Formato fixo 'YYYYMMDDT...': o ano são os 4 primeiros caracteres
+        if len(df) == 1:
+            analysis_year = parse_analysis_year(df['date'].iat[0])
+        else:
+            try:
+                analysis_year = pd.to_numeric(df['date'].str.slice(0, 4), errors='coerce').max()
+            except (AttributeError, TypeError):
+                analysis_year = ANALYSIS_YEAR_DEFAULT # Fallback ('date' não é texto)
             
         if pd.isna(analysis_year):
-            analysis_year = 2015
+            analysis_year = ANALYSIS_YEAR_DEFAULT
+        analysis_year = int(analysis_year)
     else:
-        analysis_year = 2015
+        analysis_year = ANALYSIS_YEAR_DEFAULT
 
-    df['house_age'] = analysis_year - df['yr_built']
+    # --- 3. Features de Idade e de Cômodos (do notebook 02) ---
+    columns = [df[c].to_numpy(dtype=np.float64) for c in KERNEL_INPUTS]
+    year = np.full(len(df), analysis_year, dtype=np.float64)
+    features = compute_house_features(*columns, year)
+    for k, name in enumerate(HOUSE_FEATURES):
+        df[name] = features[:, k]
+    df['was_renovated'] = df['was_renovated'].astype(int)
     
-    df['time_since_renovation'] = np.where(
-        df['yr_renovated'] == 0,
-        df['house_age'], # Se nunca reformou
-        analysis_year - df['yr_renovated'] # Se reformou
+    logger.debug("Engenharia de features concluída.")
+    return df
+
+def engineer_features_inference(record):
+    """
+    Features de UM imóvel para a predição online.
+    Recebe um dict com os campos brutos (ex: payload da API) e retorna a tupla
+    de HOUSE_FEATURES, sem DataFrame, sem cópia e sem o bloco do alvo.
+    O ano de análise vem de 'date' (ou ANALYSIS_YEAR_DEFAULT).
+    """
+    return feat_kernel(
+        *(record[c] for c in KERNEL_INPUTS), parse_analysis_year(record.get('date'))
     )
-    
-    df['was_renovated'] = (df['yr_renovated'] > 0).astype(int)
 
-    # --- 3. Features de Cômodos (do notebook 02) ---
-    df['total_rooms'] = df['bedrooms'] + df['bathrooms']
-    
-    # Evitar divisão por zero se total_rooms for 0
-    df['sqft_per_room'] = df['sqft_living'] / (df['total_rooms'] + 1e-6)
-    
-    
-    print("Engenharia de features concluída.")
-    return df
+@functools.lru_cache(maxsize=1)
+def load_base_data(path, mtime_key):
+    """
+    Lê a base merjada (Parquet, ou o CSV versionado no repositório). Fica em memória
+    enquanto o arquivo não mudar: 'mtime_key' (os.path.getmtime) invalida o cache.
+    Não modificar o retorno.
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    return pd.read_parquet(path, engine='pyarrow')
 
 def run_build_features():
     """
     Script principal:
-    1. Carrega dados 
-    2. Chama engineer_features
+    1. Carrega dados (base + feedback dos retreinos)
+    2. Chama engineer_features_train
     3. Define colunas finais (sem leakage)
     4. Faz o split
-    5. Salva train_processed.csv e test_processed.csv
+    5. Salva train_processed.parquet e test_processed.parquet
+    
+    Retorna True se os arquivos foram gerados.
     """
-    print("\nIniciando processo 'build_features'...")
+    logger.info("Iniciando processo 'build_features'...")
     
     # --- 1. Caminhos ---
     INTERIM_PATH = 'data/interim'
@@ -76,15 +178,32 @@ def run_build_features():
     os.makedirs(PROCESSED_PATH, exist_ok=True)
 
     # --- 2. Carregar Dados Merjados ---
+    # Em cache entre retreinos da API (a base nunca é reescrita, só o overlay de feedback)
+    base_path = os.path.join(INTERIM_PATH, 'merged_data.parquet')
+    if not os.path.exists(base_path):
+        # Checkout novo, sem rodar a ingestão: só o CSV está versionado
+        csv_path = os.path.join(INTERIM_PATH, 'merged_data.csv')
+        logger.warning(f"{base_path} não encontrado. Lendo {csv_path}.")
+        base_path = csv_path
     try:
-        df = pd.read_csv(os.path.join(INTERIM_PATH, 'merged_data.csv'))
+        df = load_base_data(base_path, os.path.getmtime(base_path))
     except FileNotFoundError:
-        print(f"Erro: 'merged_data.csv' não encontrado em {INTERIM_PATH}.")
-        print("Execute 'python src/data/ingest_data.py' primeiro.")
-        return
+        logger.error(f"Erro: 'merged_data.parquet' (ou 'merged_data.csv') não encontrado em {INTERIM_PATH}.")
+        logger.error("Execute 'python src/data/ingest_data.py' primeiro.")
+        return False
+
+    # Feedback incorporado pelos retreinos da API. Fica num arquivo separado
+    # para que a base original nunca seja reescrita.
+    feedback_path = os.path.join(INTERIM_PATH, 'merged_data_feedback.parquet')
+    if os.path.exists(feedback_path):
+        feedback_df = pd.read_parquet(feedback_path, engine='pyarrow')
+        # Mantém o mesmo schema da base (colunas extras do payload são descartadas)
+        feedback_df = feedback_df.reindex(columns=df.columns)
+        df = pd.concat([df, feedback_df], ignore_index=True, sort=False)
+        logger.info(f"Adicionados {len(feedback_df)} registros de feedback.")
     
     # --- 3. Aplicar Engenharia de Features ---
-    df_processed = engineer_features(df)
+    df_processed = engineer_features_train(df)
 
     # --- 4. Definir Features Finais ---
     TARGET = 'log_price'
@@ -105,22 +224,24 @@ def run_build_features():
     final_cols = FEATURES + [TARGET]
     df_final = df_processed[final_cols].fillna(0) # Preencher NaNs (ex: demográficos)
 
-    print(f"Número de features finais: {len(FEATURES)}")
+    logger.info(f"Número de features finais: {len(FEATURES)}")
 
     # --- 5. Split Train/Test ---
     # Fazemos o split APÓS criar todas as features seguras
     train_df, test_df = train_test_split(df_final, test_size=0.2, random_state=42)
 
     # --- 6. Salvar os dois arquivos ---
-    train_path = os.path.join(PROCESSED_PATH, 'train_processed.csv')
-    test_path = os.path.join(PROCESSED_PATH, 'test_processed.csv')
+    # Parquet: colunar, tipado e comprimido (o treino não re-parseia texto a cada execução)
+    train_path = os.path.join(PROCESSED_PATH, 'train_processed.parquet')
+    test_path = os.path.join(PROCESSED_PATH, 'test_processed.parquet')
     
-    train_df.to_csv(train_path, index=False)
-    test_df.to_csv(test_path, index=False)
+    train_df.to_parquet(train_path, engine='pyarrow', compression='zstd', index=False)
+    test_df.to_parquet(test_path, engine='pyarrow', compression='zstd', index=False)
 
-    print("\nProcesso 'build_features' concluído.")
-    print(f"Conjunto de treino salvo em: {train_path} ({train_df.shape})")
-    print(f"Conjunto de teste salvo em: {test_path} ({test_df.shape})")
+    logger.info("Processo 'build_features' concluído.")
+    logger.info(f"Conjunto de treino salvo em: {train_path} ({train_df.shape})")
+    logger.info(f"Conjunto de teste salvo em: {test_path} ({test_df.shape})")
+    return True
 
 if __name__ == "__main__":
     run_build_features()
\ No newline at end of file
@@ -1,9 +1,9 @@
-import pandas as pd
 import numpy as np
 import joblib
 import os
 import logging
 import time
+import math
 
 # --- Configuração de Logging (Padrão da API) ---
 logging.basicConfig(
@@ -17,12 +17,12 @@ logger = logging.getLogger(__name__)
 # --- 1. IMPORTAR a função de engenharia de features ---
 # Isso garante que a lógica de predição e treino é idêntica.
 try:
-    from src.features.build_features import engineer_features
-    logger.info("Função 'engineer_features' importada com sucesso.")
+    from src.features.build_features import engineer_features_inference, HOUSE_FEATURES
+    logger.info("Função 'engineer_features_inference' importada com sucesso.")
 except ImportError:
-    logger.error("ERRO CRÍTICO: Não foi possível importar 'engineer_features'.")
+    logger.error("ERRO CRÍTICO: Não foi possível importar 'engineer_features_inference'.")
     logger.error("Verifique se 'src/features/build_features.py' existe.")
-    engineer_features = None
+    engineer_features_inference = None
 
 # --- 2. Carregamento do Modelo (Simula o "início" da API) ---
 MODEL_PATH = 'models'
@@ -48,30 +48,32 @@ def make_prediction(input_data_dict):
     Recebe um DICIONÁRIO com os dados brutos de entrada (do usuário/API),
     aplica a engenharia de features e retorna a predição.
     """
-    if model is None or engineer_features is None:
+    if model is None or engineer_features_inference is None:
         logger.error("Tentativa de predição falhou: Modelo ou função de features não carregado.")
         return {"error": "Serviço de predição não está pronto."}
         
     try:
         start_time = time.time()
         
-        # 1. Converter dicionário para DataFrame
-        df = pd.DataFrame([input_data_dict])
-        
-        # 2. Aplicar a MESMA engenharia de features do treino
+        # 1. Aplicar a MESMA engenharia de features do treino (versão de 1 registro)
         # (Isso cria 'house_age', 'total_rooms', etc.)
-        df_processed = engineer_features(df)
+        derived = engineer_features_inference(input_data_dict)
+        features = {**input_data_dict, **dict(zip(HOUSE_FEATURES, derived))}
         
-        # 3. Alinhar colunas: Garantir que o DataFrame tenha as mesmas
-        # colunas, na mesma ordem, que o modelo foi treinado.
-        # .reindex() preenche colunas faltantes com NaN
-        df_final = df_processed.reindex(columns=model_features).fillna(0)
+        # 2. Montar a matriz na ordem que o modelo foi treinado, sem pandas:
+        # percorre 'model_features' e copia cada valor para sua coluna.
+        # Features ausentes (ou None) ficam com 0, como no antigo .fillna(0)
+        X = np.zeros((1, len(model_features)), dtype=np.float32)
+        for j, name in enumerate(model_features):
+            value = features.get(name)
+            if value is not None:
+                X[0, j] = value
 
-        # 4. Fazer a predição (no log_price)
-        prediction_log = model.predict(df_final[model_features])
+        # 3. Fazer a predição (no log_price)
+        prediction_log = model.predict(X)
         
-        # 5. Reverter para preço real
-        prediction_real = np.expm1(prediction_log[0])
+        # 4. Reverter para preço real
+        prediction_real = math.expm1(prediction_log[0])
         
         end_time = time.time()
         duration_ms = (end_time - start_time) * 1000
@@ -4,11 +4,13 @@ import joblib
 import os
 import logging
 import time
-import json  # <-- Importar JSON
-from sklearn.model_selection import RandomizedSearchCV
-from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_error, mean_absolute_percentage_error
-from xgboost import XGBRegressor
-from scipy.stats import uniform, randint
+import orjson
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import sys
+
+# xgboost/optuna/sklearn só são importados dentro de 'train()': importar este
+# módulo, como a API faz, não paga o custo de carregá-los.
 
 # --- Configuração de Logging ---
 logging.basicConfig(
@@ -19,7 +21,34 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 # ---------------------------------
 
+# Dispositivo do XGBoost: 'cpu' (padrão) ou 'cuda' para treinar os histogramas na GPU
+XGB_DEVICE = os.environ.get('XGB_DEVICE', 'cpu')
+
+def read_processed(parquet_path, columns=None):
+    """
+    Lê um split processado (.parquet). Se ele não existir (ex.: dados gerados por uma
+    versão anterior do 'build_features'), lê o .csv de mesmo nome com o parser
+    multithread do pyarrow, sem passar pela inferência de tipos do pandas.
+    """
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path, engine='pyarrow', columns=columns)
+
+    csv_path = os.path.splitext(parquet_path)[0] + '.csv'
+    logger.warning("%s não encontrado. Lendo %s.", parquet_path, csv_path)
+    convert_options = pacsv.ConvertOptions(
+        column_types={'log_price': pa.float64()}, # Alvo sempre float, mesmo se parecer inteiro
+        include_columns=columns
+    )
+    table = pacsv.read_csv(csv_path, convert_options=convert_options)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
 def train():
+    import optuna
+    import xgboost
+    from xgboost import XGBRegressor
+    from optuna_integration.xgboost import XGBoostPruningCallback
+    from sklearn.model_selection import KFold
+
     logger.info("Iniciando pipeline de treinamento ROBUSTO...")
     start_time = time.time()
     
@@ -29,97 +58,165 @@ def train():
     os.makedirs(MODEL_PATH, exist_ok=True)
 
     try:
-        train_df = pd.read_csv(os.path.join(PROCESSED_PATH, 'train_processed.csv'))
-        test_df = pd.read_csv(os.path.join(PROCESSED_PATH, 'test_processed.csv'))
+        train_df = read_processed(os.path.join(PROCESSED_PATH, 'train_processed.parquet'))
+        test_df = read_processed(os.path.join(PROCESSED_PATH, 'test_processed.parquet'))
     except FileNotFoundError:
-        logger.error(f"Erro: Arquivos de treino/teste não encontrados em {PROCESSED_PATH}.")
+        logger.error("Erro: Arquivos de treino/teste não encontrados em %s.", PROCESSED_PATH)
         logger.error("Execute 'python src/features/build_features.py' primeiro.")
         return
 
-    logger.info(f"Dados de treino carregados: {train_df.shape}")
-    logger.info(f"Dados de teste carregados: {test_df.shape}")
+    logger.info("Dados de treino carregados: %s", train_df.shape)
+    logger.info("Dados de teste carregados: %s", test_df.shape)
 
     # --- 2. Definir Target e Features ---
     TARGET = 'log_price'
     
-    # --- 2. Definir Target e Features ---
-    TARGET = 'log_price'
-    
-    y_train = train_df[TARGET]
-    X_train = train_df.drop(columns=TARGET)
+    # pop: retira o alvo do próprio DataFrame (sem montar uma cópia com as demais colunas)
+    y_train = train_df.pop(TARGET)
+    X_train = train_df
     
-    y_test = test_df[TARGET]
-    X_test = test_df.drop(columns=TARGET)
+    y_test = test_df.pop(TARGET)
+    X_test = test_df
 
     # --- 3. TUNING (Busca de Hiperparâmetros) ---
-    logger.info("Iniciando busca de hiperparâmetros (RandomizedSearchCV)...")
-
-    xgb = XGBRegressor(random_state=42, objective='reg:squarederror', n_jobs=-1)
-
-    param_dist = {
-        'n_estimators': randint(100, 500),
-        'learning_rate': uniform(0.01, 0.1),
-        'max_depth': randint(3, 8),
-        'subsample': uniform(0.7, 0.3),
-        'colsample_bytree': uniform(0.7, 0.3)
+    logger.info("Iniciando busca de hiperparâmetros (Optuna TPE + MedianPruner)...")
+
+    # Parâmetros fixos do XGBoost
+    # 'hist': features discretizadas em até 256 bins, splits avaliados por histograma
+    base_params = {
+        'objective': 'reg:squarederror',
+        'tree_method': 'hist',
+        'max_bin': 256,
+        'grow_policy': 'depthwise',
+        'device': XGB_DEVICE,
     }
-
-    random_search = RandomizedSearchCV(
-        estimator=xgb,
-        param_distributions=param_dist,
-        n_iter=10,  # Aumente para 20+ para melhores resultados
-        cv=5,       
-        scoring='neg_root_mean_squared_error',
-        verbose=2, 
-        random_state=42,
-        n_jobs=-1 
+    N_TRIALS = 50
+    CV_FOLDS = 5
+    MAX_BOOST_ROUNDS = 500 # Teto; o early stopping define o n_estimators de cada trial
+
+    # DMatrix float32 construídas uma única vez, por fold, e compartilhadas por todos
+    # os trials: o XGBoost guarda os bins do 'hist' em cada DMatrix, então os trials
+    # não re-fatiam nem re-discretizam os mesmos dados (o xgboost.cv refaria isso a cada chamada)
+    dtrain = xgboost.DMatrix(
+        X_train.to_numpy(dtype=np.float32), label=y_train.to_numpy(dtype=np.float32),
+        feature_names=list(X_train.columns)
     )
+    folds = [
+        (dtrain.slice(train_idx), dtrain.slice(val_idx))
+        for train_idx, val_idx in KFold(n_splits=CV_FOLDS).split(X_train) # Mesmos folds do antigo cv=5
+    ]
+
+    def objective(trial):
+        """RMSE médio (em log_price) do trial na validação cruzada, com early stopping."""
+        params = {
+            'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.11),
+            'max_depth': trial.suggest_int('max_depth', 3, 7),
+            'subsample': trial.suggest_float('subsample', 0.7, 1.0),
+            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.7, 1.0),
+        }
+        fold_rmse, fold_rounds = [], []
+        for i, (dtrain_fold, dval_fold) in enumerate(folds):
+            # Interrompe o trial se, na mesma rodada do 1º fold, ele estiver pior que a mediana dos anteriores
+            callbacks = [XGBoostPruningCallback(trial, 'val-rmse')] if i == 0 else None
+            booster = xgboost.train(
+                {**base_params, **params, 'seed': 42, 'nthread': 1}, # 1 thread por trial
+                dtrain_fold,
+                num_boost_round=MAX_BOOST_ROUNDS,
+                evals=[(dval_fold, 'val')],
+                early_stopping_rounds=20,
+                verbose_eval=False,
+                callbacks=callbacks
+            )
+            fold_rmse.append(booster.best_score)
+            fold_rounds.append(booster.best_iteration + 1)
+        trial.set_user_attr('n_estimators', int(round(np.mean(fold_rounds))))
+        return float(np.mean(fold_rmse))
+
+    study = optuna.create_study(
+        direction='minimize',
+        sampler=optuna.samplers.TPESampler(seed=42),
+        pruner=optuna.pruners.MedianPruner(n_warmup_steps=30)
+    )
+    # Trials em threads (o XGBoost libera o GIL) compartilhando as mesmas DMatrix
+    study.optimize(objective, n_trials=N_TRIALS, n_jobs=-1)
 
-    random_search.fit(X_train, y_train)
+    best_params = {**study.best_params, 'n_estimators': study.best_trial.user_attrs['n_estimators']}
+    n_pruned = sum(t.state == optuna.trial.TrialState.PRUNED for t in study.trials)
 
-    logger.info("Busca de hiperparâmetros concluída.")
-    logger.info(f"Melhores parâmetros encontrados: {random_search.best_params_}")
+    logger.info("Busca de hiperparâmetros concluída (%d de %d trials interrompidos).", n_pruned, N_TRIALS)
+    logger.info("Melhores parâmetros encontrados: %s", best_params)
 
-    best_model = random_search.best_estimator_
+    # Refit com os melhores parâmetros no DataFrame (guarda 'feature_names_in_' para a API)
+    best_model = XGBRegressor(
+        **base_params,
+        **best_params,
+        random_state=42,
+        enable_categorical=False, # Todas as colunas são numéricas
+        n_jobs=os.cpu_count()
+    )
+    best_model.fit(X_train, y_train)
 
     # --- 4. Relatório de Performance Detalhado ---
     logger.info("Gerando relatório de performance...")
     
     # Métricas de VALIDAÇÃO (Cross-Validation)
-    # Este é o "erro médio" que o RandomizedSearch viu durante o tuning
-    best_cv_score_rmse = -random_search.best_score_
-    logger.info(f"Melhor RMSE (Validação CV, em log_price): {best_cv_score_rmse:.4f}")
+    # Este é o "erro médio" que a busca viu durante o tuning
+    best_cv_score_rmse = study.best_value
+    logger.info("Melhor RMSE (Validação CV, em log_price): %.4f", best_cv_score_rmse)
 
     # Métricas de TESTE (No conjunto isolado)
     y_pred_log = best_model.predict(X_test)
     
-    y_test_price = np.expm1(y_test)
+    y_test_price = np.expm1(y_test.to_numpy())
     y_pred_price = np.expm1(y_pred_log)
     
-    # Calcular métricas
-    r2_final = r2_score(y_test_price, y_pred_price)
-    rmse_final_usd = np.sqrt(mean_squared_error(y_test_price, y_pred_price))
-    mae_final_usd = mean_absolute_error(y_test_price, y_pred_price)
-    mape_final_pct = mean_absolute_percentage_error(y_test_price, y_pred_price) * 100
+    # Calcular métricas (todas a partir de um único vetor de erros)
+    err = y_test_price - y_pred_price
+    abs_err = np.abs(err)
+    mse = np.dot(err, err) / len(err)
+    ss_tot = np.sum((y_test_price - y_test_price.mean()) ** 2)
+    r2_final = float(1 - mse * len(err) / ss_tot)
+    rmse_final_usd = float(np.sqrt(mse))
+    mae_final_usd = float(abs_err.mean())
+    mape_final_pct = float((abs_err / np.maximum(np.abs(y_test_price), 1e-8)).mean() * 100) # 1e-8: evita divisão por zero
 
     # O Relatório Profissional
-    logger.info("\n\n" + "="*50)
-    logger.info("--- RELATÓRIO DE PERFORMANCE DO NOVO MODELO ---")
-    logger.info("="*50)
-    logger.info(f"Fonte dos Dados de Teste: {PROCESSED_PATH}/test_processed.csv")
-    logger.info(f"Tamanho do Conjunto de Teste: {len(X_test)} amostras")
-    logger.info("\n--- Métricas de Negócio (em Dólares) ---")
-    logger.info(f"R² (R-squared):           {r2_final:.4f}")
-    logger.info(f"MAE (Erro Médio em $):    ${mae_final_usd:,.2f}")
-    logger.info(f"RMSE (Erro Padrão em $):  ${rmse_final_usd:,.2f}")
-    logger.info(f"MAPE (Erro Percentual):   {mape_final_pct:.2f}%")
-    logger.info("\n" + "-"*50 + "\n")
+    # Um único registro de log com o relatório inteiro
+    report_lines = [
+        "",
+        "=" * 50,
+        "--- RELATÓRIO DE PERFORMANCE DO NOVO MODELO ---",
+        "=" * 50,
+        f"Fonte dos Dados de Teste: {PROCESSED_PATH}/test_processed.parquet",
+        f"Tamanho do Conjunto de Teste: {len(X_test)} amostras",
+        "",
+        "--- Métricas de Negócio (em Dólares) ---",
+        f"R² (R-squared):           {r2_final:.4f}",
+        f"MAE (Erro Médio em $):    ${mae_final_usd:,.2f}",
+        f"RMSE (Erro Padrão em $):  ${rmse_final_usd:,.2f}",
+        f"MAPE (Erro Percentual):   {mape_final_pct:.2f}%",
+        "-" * 50,
+    ]
+    logger.info("\n".join(report_lines))
 
 
     # --- 5. Salvar o Modelo Final ---
     model_output_path = os.path.join(MODEL_PATH, 'model.joblib')
-    joblib.dump(best_model, model_output_path)
-    logger.info(f"Modelo final (otimizado) salvo com sucesso em: {model_output_path}")
+    # Escrita atômica: a API vigia este arquivo e recarrega assim que ele muda
+    temp_model_path = model_output_path + '.tmp'
+    joblib.dump(best_model, temp_model_path)
+    os.replace(temp_model_path, model_output_path)
+    logger.info("Modelo final (otimizado) salvo com sucesso em: %s", model_output_path)
+
+    # Formato nativo do XGBoost (UBJSON: só as árvores, portável entre versões).
+    # O 'load_model' não restaura atributos do sklearn, então as features vão num JSON à parte.
+    # (A API continua usando o .joblib.)
+    native_output_path = os.path.join(MODEL_PATH, 'model.ubj')
+    features_output_path = os.path.join(MODEL_PATH, 'model_features.json')
+    best_model.save_model(native_output_path)
+    with open(features_output_path, 'wb') as f:
+        f.write(orjson.dumps(list(best_model.feature_names_in_), option=orjson.OPT_INDENT_2))
+    logger.info("Modelo nativo salvo em: %s (features em %s)", native_output_path, features_output_path)
 
     # --- 6. NOVO: Salvar Métricas ---
     metrics_output_path = os.path.join(MODEL_PATH, 'model_metrics.json')
@@ -127,18 +224,27 @@ def train():
         "r2": r2_final,
         "rmse_usd": rmse_final_usd,
         "mae_usd": mae_final_usd,
-        "mape_pct": mape_final_pct,
-        "mae_usd_formatted": f"${mae_final_usd:,.2f}" # Salva o valor formatado
+        "mape_pct": mape_final_pct
     }
-    with open(metrics_output_path, 'w') as f:
-        json.dump(metrics, f, indent=4)
-    logger.info(f"Métricas do modelo salvas com sucesso em: {metrics_output_path}")
+    # Escrita atômica: a API nunca lê um JSON pela metade durante o retreino
+    temp_path = metrics_output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(orjson.dumps(metrics, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    os.replace(temp_path, metrics_output_path)
+    logger.info("Métricas do modelo salvas com sucesso em: %s", metrics_output_path)
     # --------------------------------
 
     elapsed = time.time() - start_time
-    logger.info(f"Pipeline de treinamento concluído em {elapsed:.2f} segundos.")
+    logger.info("Pipeline de treinamento concluído em %.2f segundos.", elapsed)
     
     return metrics # Retorna as métricas para o ciclo de retreino
 
 if __name__ == "__main__":
+    # O paralelismo fica na busca (um candidato por núcleo). No Linux, fixa o
+    # OpenMP do XGBoost em 1 thread ANTES do import (feito em 'train()'), para que
+    # cada candidato não abra um pool com todos os núcleos (núcleos² threads).
+    # Só ao rodar o script: quem importa o módulo (a API) mantém o OpenMP padrão;
+    # os trials e o refit já fixam 'nthread'/'n_jobs' explicitamente.
+    if sys.platform.startswith('linux'):
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
     train()
\ No newline at end of file
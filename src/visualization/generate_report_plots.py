@@ -1,21 +1,23 @@
 import pandas as pd
 import numpy as np
-import joblib
 import os
 import logging
-import shap
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, mean_absolute_percentage_error
+import hashlib
+import orjson
+import pyarrow as pa
+from pyarrow import csv as pacsv
 
 # --- Configuração ---
 logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Caminhos ---
-MODEL_PATH = 'models/model.joblib'
-TEST_DATA_PATH = 'data/processed/test_processed.csv'
+MODEL_PATH = 'models/model.ubj' # Formato nativo do XGBoost
+MODEL_FEATURES_PATH = 'models/model_features.json' # Ordem das features do treino
+TEST_DATA_PATH = 'data/processed/test_processed.parquet'
 OUTPUT_IMAGE_DIR = 'docs/images' # Pasta para salvar os gráficos
+CACHE_DIR = 'cache' # Predições e valores SHAP já calculados (.npy)
+XGB_DEVICE = os.environ.get('XGB_DEVICE', 'cpu') # 'cuda' calcula o SHAP na GPU (GPUTreeShap)
 
 # --- Função Auxiliar para Encontrar Nomes de Features (AGORA USADA) ---
 def find_feature_name(df, partial_name):
@@ -30,12 +32,63 @@ def find_feature_name(df, partial_name):
             return col 
     return partial_name # Retorna o nome original se não for encontrado
 
+# --- Leitura dos Dados Processados ---
+def read_processed(parquet_path, columns=None):
+    """
+    Lê um split processado (.parquet). Se ele não existir (ex.: dados gerados por uma
+    versão anterior do 'build_features'), lê o .csv de mesmo nome com o parser
+    multithread do pyarrow, sem passar pela inferência de tipos do pandas.
+    """
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path, engine='pyarrow', columns=columns)
+
+    csv_path = os.path.splitext(parquet_path)[0] + '.csv'
+    logger.warning(f"{parquet_path} não encontrado. Lendo {csv_path}.")
+    convert_options = pacsv.ConvertOptions(
+        column_types={'log_price': pa.float64()}, # Alvo sempre float, mesmo se parecer inteiro
+        include_columns=columns
+    )
+    table = pacsv.read_csv(csv_path, convert_options=convert_options)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# --- Cache em Disco (Predições e SHAP) ---
+def cache_key(*parts) -> str:
+    """Hash curto (blake2b) das partes que determinam o resultado (shape, mtimes...)."""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+def cached_array(name, key, compute):
+    """
+    Carrega 'cache/{name}_{key}.npy' se existir; senão chama 'compute()' e salva.
+    Como a chave inclui os mtimes do modelo e dos dados, um novo treino invalida o cache.
+    """
+    path = os.path.join(CACHE_DIR, f"{name}_{key}.npy")
+    if os.path.exists(path):
+        logger.info(f"Usando cache: {path}")
+        return np.load(path)
+
+    result = np.asarray(compute())
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, result)
+    os.replace(temp_path, path)
+    return result
+
 def generate_analysis():
     """
     Carrega o modelo final e os dados de teste para
     gerar e salvar todos os gráficos e métricas
     necessários para os relatórios.
     """
+    # Imports pesados (shap, matplotlib, seaborn) só quando o relatório é gerado
+    import matplotlib
+    matplotlib.use('Agg') # Backend sem janela: só salva PNGs
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    import seaborn as sns
+    import shap
+    import xgboost
+
     logger.info("Iniciando a geração de artefatos de análise...")
     
     # Criar pasta de saída
@@ -43,44 +96,64 @@ def generate_analysis():
 
     # --- 1. Carregar Modelo e Dados ---
     try:
-        model = joblib.load(MODEL_PATH)
+        with open(MODEL_FEATURES_PATH, 'rb') as f:
+            model_features = orjson.loads(f.read())
+        if not os.path.exists(MODEL_PATH): # O XGBoost não levanta FileNotFoundError
+            raise FileNotFoundError(MODEL_PATH)
+        model = xgboost.XGBRegressor()
+        model.load_model(MODEL_PATH)
         logger.info(f"Modelo {MODEL_PATH} carregado.")
         
-        test_df = pd.read_csv(TEST_DATA_PATH)
+        # Lê do Parquet só as colunas usadas: as features do modelo e o alvo
+        columns = model_features + ['log_price']
+        test_df = read_processed(TEST_DATA_PATH, columns=columns)
         logger.info(f"Dados de teste {TEST_DATA_PATH} carregados.")
     except FileNotFoundError as e:
         logger.error(f"Erro: Arquivo não encontrado. {e}")
         logger.error("Certifique-se de que o modelo foi treinado ('train_model.py') e os dados processados ('build_features.py').")
         return
+    except (ValueError, KeyError) as e: # Coluna pedida em 'columns' não existe: ArrowInvalid (Parquet) ou ArrowKeyError (CSV)
+        logger.error(f"Erro de coluna: {e}. O modelo foi treinado com features diferentes das do 'test_processed.parquet'.")
+        return
 
     # Separar X e y
     TARGET = 'log_price'
-    y_test = test_df[TARGET]
-    X_test = test_df.drop(columns=TARGET)
+    y_test = test_df.pop(TARGET) # Retira o alvo sem copiar as demais colunas
+    X_test = test_df
     
     # Garantir que as colunas do X_test correspondem ao modelo
-    try:
-        X_test = X_test[model.feature_names_in_]
-    except AttributeError:
-        logger.warning("Atributo 'feature_names_in_' não encontrado. O modelo pode ser de uma versão antiga do scikit-learn.")
-    except KeyError as e:
-        logger.error(f"Erro de coluna: {e}. O modelo foi treinado com features diferentes das do 'test_processed.csv'.")
+    # (reindex sem cópia: com o Copy-on-Write do pandas, os dados só são copiados se alterados)
+    missing = [col for col in model_features if col not in X_test.columns]
+    if missing:
+        logger.error(f"Erro de coluna: {missing}. O modelo foi treinado com features diferentes das do 'test_processed.parquet'.")
         return
+    X_test = X_test.reindex(columns=model_features)
+
+    # Matriz float32 contígua (o dtype interno do XGBoost) usada nas predições
+    X_test_np = np.ascontiguousarray(X_test.to_numpy(dtype=np.float32))
 
 
     # --- 2. Gerar Predições e Métricas ---
     logger.info("Calculando métricas finais...")
-    y_pred_log = model.predict(X_test)
+    # Mesmo modelo + mesmos dados = mesmas predições: reaproveita do cache se possível
+    data_path = TEST_DATA_PATH if os.path.exists(TEST_DATA_PATH) else os.path.splitext(TEST_DATA_PATH)[0] + '.csv'
+    data_key = (X_test.shape, os.path.getmtime(MODEL_PATH), os.path.getmtime(data_path))
+    y_pred_log = cached_array('y_pred_log', cache_key(*data_key), lambda: model.predict(X_test_np))
     
     # Reverter para preço real (dólares)
     y_test_price = np.expm1(y_test)
     y_pred_price = np.expm1(y_pred_log)
 
-    # Métricas
-    r2 = r2_score(y_test_price, y_pred_price)
-    mae = mean_absolute_error(y_test_price, y_pred_price)
-    rmse = np.sqrt(mean_squared_error(y_test_price, y_pred_price))
-    mape = mean_absolute_percentage_error(y_test_price, y_pred_price) * 100
+    # Métricas (todas a partir de um único vetor de erros)
+    errors = y_test_price - y_pred_price # Erro em dólares
+    err = errors.to_numpy()
+    abs_err = np.abs(err)
+    mse = np.dot(err, err) / len(err)
+    y_true = y_test_price.to_numpy()
+    r2 = 1 - mse * len(err) / np.sum((y_true - y_true.mean()) ** 2)
+    mae = abs_err.mean()
+    rmse = np.sqrt(mse)
+    mape = (abs_err / np.maximum(np.abs(y_true), 1e-8)).mean() * 100 # 1e-8: evita divisão por zero
 
     # Imprimir métricas para o usuário copiar
     print("\n\n" + "="*50)
@@ -92,75 +165,79 @@ def generate_analysis():
     print(f"MAPE (Erro Percentual):   {mape:.2f}%")
     print("\nCOPIE OS VALORES ACIMA E COLE NOS ARQUIVOS .md\n" + "="*50 + "\n")
 
+    # Uma única Figure reaproveitada por todos os gráficos (limpa com clf() entre eles),
+    # em vez de criar e destruir uma Figure (e seu estado de fontes/backend) por PNG
+    fig = plt.figure(figsize=(10, 6))
+
+    def save_figure(filename):
+        """Salva a Figure em OUTPUT_IMAGE_DIR e a limpa para o próximo gráfico."""
+        plot_path = os.path.join(OUTPUT_IMAGE_DIR, filename)
+        fig.savefig(plot_path, dpi=150, bbox_inches='tight')
+        fig.clf()
+        fig.set_size_inches(10, 6)
+        logger.info(f"Gráfico salvo em: {plot_path}")
+
     # --- 3. Gerar Gráfico: Previsto vs. Real ---
     logger.info("Gerando gráfico: Previsto vs. Real...")
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(x=y_test_price, y=y_pred_price, alpha=0.3, s=15, color='#3b82f6') # Azul
-    plt.plot([y_test_price.min(), y_test_price.max()], [y_test_price.min(), y_test_price.max()], 'r--', lw=2)
-    plt.title('Valor Real vs. Valor Previsto (em $)', fontsize=16)
-    plt.xlabel('Valor Real ($)', fontsize=12)
-    plt.ylabel('Valor Previsto ($)', fontsize=12)
-    plt.gca().ticklabel_format(style='plain', axis='both')
-    
-    plot_path = os.path.join(OUTPUT_IMAGE_DIR, 'prediction_vs_actual.png')
-    plt.savefig(plot_path, dpi=150, bbox_inches='tight')
-    plt.close()
-    logger.info(f"Gráfico salvo em: {plot_path}")
+    ax = fig.add_subplot()
+    # hexbin: desenha células de uma grade, não um marcador por ponto
+    # (escala log com vmin < 1 para que células com 1 imóvel não sumam no branco)
+    hb = ax.hexbin(y_test_price, y_pred_price, gridsize=80, cmap='Blues', mincnt=1, norm=LogNorm(vmin=0.3))
+    fig.colorbar(hb, ax=ax, label='Contagem (escala log)')
+    ax.plot([y_test_price.min(), y_test_price.max()], [y_test_price.min(), y_test_price.max()], 'r--', lw=2)
+    ax.set_title('Valor Real vs. Valor Previsto (em $)', fontsize=16)
+    ax.set_xlabel('Valor Real ($)', fontsize=12)
+    ax.set_ylabel('Valor Previsto ($)', fontsize=12)
+    ax.ticklabel_format(style='plain', axis='both')
+    save_figure('prediction_vs_actual.png')
 
     # --- 4. Gerar Gráfico: Histograma de Erros ---
     logger.info("Gerando gráfico: Histograma de Erros...")
-    errors = y_test_price - y_pred_price # Erro em dólares
-    
-    plt.figure(figsize=(10, 6))
-    sns.histplot(errors, kde=True, bins=50, color='#3b82f6')
-    plt.axvline(x=0, color='red', linestyle='--')
-    plt.title('Distribuição dos Erros de Predição (em $)', fontsize=16)
-    plt.xlabel('Erro (Valor Real - Valor Previsto)', fontsize=12)
-    plt.ylabel('Contagem', fontsize=12)
-    plt.gca().ticklabel_format(style='plain', axis='x')
-    
-    plot_path = os.path.join(OUTPUT_IMAGE_DIR, 'error_distribution.png')
-    plt.savefig(plot_path, dpi=150, bbox_inches='tight')
-    plt.close()
-    logger.info(f"Gráfico salvo em: {plot_path}")
+    ax = fig.add_subplot()
+    sns.histplot(errors, kde=True, bins=50, color='#3b82f6', ax=ax)
+    ax.axvline(x=0, color='red', linestyle='--')
+    ax.set_title('Distribuição dos Erros de Predição (em $)', fontsize=16)
+    ax.set_xlabel('Erro (Valor Real - Valor Previsto)', fontsize=12)
+    ax.set_ylabel('Contagem', fontsize=12)
+    ax.ticklabel_format(style='plain', axis='x')
+    save_figure('error_distribution.png')
 
     # --- 5. Gerar Gráfico: Análise de Resíduos ---
     logger.info("Gerando gráfico: Análise de Resíduos...")
-    
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(x=y_test_price, y=errors, alpha=0.3, s=15, color='#3b82f6')
-    plt.axhline(y=0, color='red', linestyle='--')
-    plt.title('Análise de Resíduos (Erro vs. Preço Real)', fontsize=16)
-    plt.xlabel('Valor Real ($)', fontsize=12)
-    plt.ylabel('Erro (Resíduo em $)', fontsize=12)
-    plt.gca().ticklabel_format(style='plain', axis='both')
-    
-    plot_path = os.path.join(OUTPUT_IMAGE_DIR, 'residuals_plot.png')
-    plt.savefig(plot_path, dpi=150, bbox_inches='tight')
-    plt.close()
-    logger.info(f"Gráfico salvo em: {plot_path}")
+    ax = fig.add_subplot()
+    hb = ax.hexbin(y_test_price, errors, gridsize=80, cmap='Blues', mincnt=1, norm=LogNorm(vmin=0.3))
+    fig.colorbar(hb, ax=ax, label='Contagem (escala log)')
+    ax.axhline(y=0, color='red', linestyle='--')
+    ax.set_title('Análise de Resíduos (Erro vs. Preço Real)', fontsize=16)
+    ax.set_xlabel('Valor Real ($)', fontsize=12)
+    ax.set_ylabel('Erro (Resíduo em $)', fontsize=12)
+    ax.ticklabel_format(style='plain', axis='both')
+    save_figure('residuals_plot.png')
 
     # --- 6. Gerar Gráfico: SHAP Summary Plot ---
     logger.info("Calculando valores SHAP... (Isso pode demorar)")
     
-    sample_size = min(1000, len(X_test))
-    X_test_sample = X_test.sample(n=sample_size, random_state=1)
+    # 100 linhas já dão o mesmo quadro geral do summary plot (o custo do TreeSHAP é por linha)
+    sample_size = min(100, len(X_test))
+    X_test_sample = shap.sample(X_test, sample_size, random_state=1)
     
-    explainer = shap.TreeExplainer(model)
-    
-    shap_values_raw = explainer.shap_values(X_test_sample) 
+    def compute_shap_values():
+        # TreeSHAP nativo do XGBoost (C++, multithread; GPUTreeShap com device='cuda')
+        booster = model.get_booster()
+        booster.set_param({'device': XGB_DEVICE})
+        contribs = booster.predict(xgboost.DMatrix(X_test_sample), pred_contribs=True)
+        return contribs[:, :-1] # A última coluna é o viés (valor esperado)
+
+    shap_values_raw = cached_array('shap_values', cache_key(*data_key, 'shap.sample', sample_size, 1), compute_shap_values)
 
     logger.info("Gerando gráfico: SHAP Summary Plot...")
-    plt.figure()
+    plt.figure(fig.number) # O SHAP desenha na Figure atual (plt.gcf())
     
     shap.summary_plot(shap_values_raw, X_test_sample, show=False, max_display=15)
     
-    fig = plt.gcf()
     fig.set_size_inches(10, 7)
-    plot_path = os.path.join(OUTPUT_IMAGE_DIR, 'shap_summary.png')
-    plt.savefig(plot_path, dpi=150, bbox_inches='tight')
-    plt.close()
-    logger.info(f"Gráfico salvo em: {plot_path}")
+    save_figure('shap_summary.png')
+    plt.close(fig)
     
     logger.info("Análise concluída. Todos os gráficos foram salvos em 'docs/images/'.")
 